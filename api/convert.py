@@ -1,13 +1,155 @@
 from flask import Flask, request, jsonify
 import fitz  # PyMuPDF
+import orjson
 import tempfile
 import os
+import gc
+import gzip
+import hashlib
 import json
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain, repeat
 
 app = Flask(__name__)
 
+# PyMuPDF holds the GIL, so pages are parsed in worker processes. The pool is
+# created once per container so warm invocations reuse the spawned workers.
+MAX_WORKERS = min(os.cpu_count() or 1, 4)
+
+def create_executor():
+    """Start the worker pool, or None where the sandbox cannot run one"""
+    try:
+        return ProcessPoolExecutor(max_workers=MAX_WORKERS)
+    except OSError:
+        # Sandboxes without /dev/shm (e.g. AWS Lambda) cannot create process pools
+        return None
+
+executor = create_executor()
+
+# Recently extracted documents keyed by (SHA-256 of the upload, format)
+RESULT_CACHE_SIZE = 32
+# Entries are whole documents, so the cache is also bounded by total length
+# (in characters) to stay well inside the function's memory limit
+RESULT_CACHE_MAX_CHARS = 16 * 1024 * 1024
+result_cache = OrderedDict()
+result_cache_chars = 0
+
+HTML_HEAD = ('<!DOCTYPE html>', '<html>', '<head>', 
+             '<meta charset="UTF-8">', '<title>PDF Content</title>', 
+             '</head>', '<body>')
+HTML_TAIL = ('</body>', '</html>')
+
+# Plain text has no use for ligature glyphs, so MuPDF decomposes them (fi, fl)
+# instead of preserving them
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+# Default XHTML flags minus TEXT_PRESERVE_IMAGES, which would inline every
+# image as base64 into the response
+XHTML_FLAGS = fitz.TEXTFLAGS_XHTML & ~fitz.TEXT_PRESERVE_IMAGES
+
+def _extract_page(page, mode):
+    """Extract one page as plain text or a pre-rendered HTML fragment"""
+    # Build the page's TextPage once and call its extractor directly,
+    # skipping get_text's per-call option dispatch
+    if mode == "txt":
+        return page.get_textpage(flags=TEXT_FLAGS).extractText()
+    
+    # MuPDF's native emitter produces <p> per paragraph with <b>/<i> markup,
+    # so no per-span work happens in Python
+    return page.get_textpage(flags=XHTML_FLAGS).extractXHTML()
+
+def _extract_pages(pdf_bytes, start, stop, mode):
+    """Worker entry point: re-open the PDF and extract a contiguous page range"""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [_extract_page(doc[i], mode) for i in range(start, stop)]
+
+def iter_pages(pdf_bytes, page_count, mode):
+    """Yield extracted pages in order, splitting the page range across the pool"""
+    global executor
+    if executor is None or page_count <= 1:
+        # Lazily, so a streamed response only ever holds the current page
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            for page in doc:
+                yield _extract_page(page, mode)
+        return
+    
+    # One contiguous range per worker so the PDF bytes are shipped once each
+    step = -(-page_count // MAX_WORKERS)
+    done = 0
+    for attempt in range(2):
+        starts = range(done, page_count, step)
+        stops = [min(start + step, page_count) for start in starts]
+        try:
+            for chunk in executor.map(_extract_pages, repeat(pdf_bytes), starts, stops, repeat(mode)):
+                yield from chunk
+                done += len(chunk)
+            return
+        except BrokenProcessPool:
+            # A dead worker (MuPDF crash, OOM kill) breaks the pool for good.
+            # The remaining pages get one more try on a fresh pool, never in
+            # this process, which the same input could take down too.
+            executor.shutdown(wait=False)
+            executor = create_executor()
+            if attempt or executor is None:
+                raise
+
+def count_pages(pdf_bytes):
+    """Open the PDF only to count pages; workers re-open it themselves"""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+def extract_content(pdf_bytes, mode):
+    """Extract the whole document as one txt or html string"""
+    global result_cache_chars
+    # Retries and repeat previews of the same upload skip PyMuPDF entirely
+    key = (hashlib.sha256(pdf_bytes).digest(), mode)
+    content = result_cache.get(key)
+    if content is not None:
+        result_cache.move_to_end(key)
+        return content
+    
+    pages = iter_pages(pdf_bytes, count_pages(pdf_bytes), mode)
+    
+    if mode == "txt":
+        # Simple text extraction, written into one growable buffer
+        buf = StringIO()
+        for page_text in pages:
+            buf.write(page_text)
+            buf.write("\n")
+        content = buf.getvalue()
+    else:
+        # Basic HTML extraction, joined in one pass over all fragments
+        fragments = (fragment for fragment in pages if fragment)
+        content = '\n'.join(chain(HTML_HEAD, fragments, HTML_TAIL))
+    
+    # Documents bigger than a quarter of the budget would only flush the rest
+    if len(content) <= RESULT_CACHE_MAX_CHARS // 4 and key not in result_cache:
+        result_cache[key] = content
+        result_cache_chars += len(content)
+        while len(result_cache) > RESULT_CACHE_SIZE or result_cache_chars > RESULT_CACHE_MAX_CHARS:
+            result_cache_chars -= len(result_cache.popitem(last=False)[1])
+    return content
+
+def ndjson_lines(pages):
+    """Yield one NDJSON record per extracted page"""
+    for i, text in enumerate(pages):
+        yield orjson.dumps({"page": i, "text": text}) + b"\n"
+
+def json_response(request, payload):
+    """JSON response, gzip-compressed when the client accepts it"""
+    # orjson emits UTF-8 bytes directly, without escaping non-ASCII text
+    body = orjson.dumps(payload)
+    response = app.response_class(body, mimetype="application/json")
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        # Level 1: extracted text compresses well and egress is the bottleneck
+        response.set_data(gzip.compress(body, compresslevel=1))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 def handler(request):
     """Main Vercel serverless function handler"""
     if request.method == 'POST':
@@ -17,74 +159,35 @@ def handler(request):
                 return jsonify({"error": "No PDF file provided"}), 400
             
             file = request.files['pdf_file']
+            stem = os.path.splitext(file.filename)[0]
             export_format = request.form.get('export_format', 'txt')
             layout_mode = request.form.get('layout_mode', 'preserve')
             
             # Process in memory instead of file system
             pdf_data = file.read()
             
-            # Open PDF from memory
-            doc = fitz.open(stream=pdf_data, filetype="pdf")
+            if export_format not in ("txt", "html"):
+                return jsonify({"error": "Unsupported format for serverless"}), 400
             
-            if export_format == "txt":
-                # Simple text extraction
-                full_text = ""
-                for page in doc:
-                    full_text += page.get_text("text") + "\n"
-                
-                doc.close()
-                
-                return jsonify({
-                    "success": True,
-                    "content": full_text,
-                    "format": "txt",
-                    "filename": f"{file.filename.rsplit('.', 1)[0]}.txt"
-                })
+            # Clients that accept NDJSON get pages as they are extracted
+            # instead of one buffered document
+            if 'application/x-ndjson' in request.headers.get('Accept', ''):
+                pages = iter_pages(pdf_data, count_pages(pdf_data), export_format)
+                return app.response_class(ndjson_lines(pages), mimetype="application/x-ndjson")
             
-            elif export_format == "html":
-                # Basic HTML extraction
-                html_content = ['<!DOCTYPE html>', '<html>', '<head>', 
-                               '<meta charset="UTF-8">', '<title>PDF Content</title>', 
-                               '</head>', '<body>']
-                
-                for page in doc:
-                    blocks = page.get_text("dict")["blocks"]
-                    for block in blocks:
-                        if "lines" in block:
-                            for line in block["lines"]:
-                                line_text = ""
-                                for span in line["spans"]:
-                                    text = span["text"].strip()
-                                    if text:
-                                        flags = span["flags"]
-                                        is_bold = bool(flags & 2**4)
-                                        is_italic = bool(flags & 2**1)
-                                        
-                                        if is_bold and is_italic:
-                                            text = f'<strong><em>{text}</em></strong>'
-                                        elif is_bold:
-                                            text = f'<strong>{text}</strong>'
-                                        elif is_italic:
-                                            text = f'<em>{text}</em>'
-                                        
-                                        line_text += text + ' '
-                                
-                                if line_text.strip():
-                                    html_content.append(f'<p>{line_text.strip()}</p>')
-                
-                html_content.extend(['</body>', '</html>'])
-                doc.close()
-                
-                return jsonify({
-                    "success": True,
-                    "content": '\n'.join(html_content),
-                    "format": "html",
-                    "filename": f"{file.filename.rsplit('.', 1)[0]}.html"
-                })
+            content = extract_content(pdf_data, export_format)
             
-            else:
-                doc.close()
-                return jsonify({"error": "Unsupported format for serverless"}), 400
+            # Drop the source PDF before serialization so it is not held
+            # alongside the output and its JSON-encoded copy
+            del pdf_data
+            gc.collect()
+            
+            return json_response(request, {
+                "success": True,
+                "content": content,
+                "format": export_format,
+                "filename": stem + "." + export_format
+            })
                 
         except Exception as e:
             return jsonify({"error": str(e)}), 500
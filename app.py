@@ -1,29 +1,224 @@
-from flask import Flask, request, send_file, jsonify, session
+from flask import Flask, Response, request, send_file, jsonify, session, after_this_request
 import fitz  # PyMuPDF
+import redis
 import os
 import re
+import sys
 import time
 import zipfile
 import tempfile
+import shutil
 import json
+import io
 import uuid
+import pickle
+import copy
+import mmap
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from bisect import bisect_right
 from datetime import datetime, timedelta
 from docx import Document
-from docx.shared import Pt
+from docx.shared import Inches
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml.ns import qn
+from lxml import etree
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'pdf2preserve_secret_key_change_in_production')
 UPLOAD_FOLDER = "/tmp/uploads" if os.environ.get("RAILWAY_ENVIRONMENT") else "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Export tracking storage (in production, use a database)
-export_tracking = {}
+# Extracted blocks persisted by PDF content hash, so repeat exports of the
+# same file skip extraction entirely
+EXTRACT_CACHE_DIR = os.path.join(UPLOAD_FOLDER, "extract_cache")
+EXTRACT_CACHE_MAX_ENTRIES = 256
+EXTRACT_CACHE_VERSION = 5  # Bump whenever the block/span layout changes
+os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+
+# Export tracking storage: Redis when REDIS_URL is configured, so counts are
+# atomic and shared across workers; otherwise an in-process dict
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+export_tracking = {}  # user key -> exports on export_tracking_day
+export_tracking_day = None
+export_tracking_lock = threading.Lock()
 
 # Export limits
 GUEST_DAILY_LIMIT = 10
 LOGGED_IN_DAILY_LIMIT = 30
 
+# Default "dict" extraction flags minus TEXT_PRESERVE_IMAGES, so image blocks
+# (and their pixel data) are never built
+DICT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Flags for the get_text("text") readers (txt exports and clean-mode pages):
+# ligatures come out as their letters, so "ﬁ" in a PDF exports as "fi"
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+# PyMuPDF span flag bits
+FLAG_ITALIC = 2
+FLAG_BOLD = 16
+
+# Line alignment is stored as an index into these tuples and only turned into
+# a CSS/Markdown name or a Word constant when writing output
+ALIGN_LEFT, ALIGN_CENTER, ALIGN_RIGHT = 0, 1, 2
+ALIGNMENT_NAMES = ('left', 'center', 'right')
+DOCX_ALIGNMENTS = (WD_PARAGRAPH_ALIGNMENT.LEFT, WD_PARAGRAPH_ALIGNMENT.CENTER, WD_PARAGRAPH_ALIGNMENT.RIGHT)
+
+# Characters that must not reach HTML output unescaped
+HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+
+# Markup wrapped around a span's text, keyed by (bold, italic)
+SPAN_WRAPS = {
+    'plain': {(False, False): '%s', (True, False): '%s', (False, True): '%s', (True, True): '%s'},
+    'html': {(False, False): '%s', (True, False): '<strong>%s</strong>',
+             (False, True): '<em>%s</em>', (True, True): '<strong><em>%s</em></strong>'},
+    'md': {(False, False): '%s', (True, False): '**%s**', (False, True): '*%s*', (True, True): '***%s***'},
+}
+
+# Shared default for blocks/lines without a bbox
+EMPTY_BBOX = (0.0,) * 4
+
+# List detection, compiled once at import
+BULLET_PATTERNS = ('•', '●', '◦', '▪', '▫', '■', '□', '◆', '◇', '-', '*')
+BULLET_PREFIXES = tuple(b + ' ' for b in BULLET_PATTERNS) + tuple(b + '\t' for b in BULLET_PATTERNS)
+LIST_ITEM_RE = re.compile(r'^(?:(\d+[.)])|([a-zA-Z][.)])|([ivxlcdm]+\.|[IVXLCDM]+\.))\s')
+LIST_ITEM_TYPES = (None, 'numbered', 'lettered', 'roman')  # by LIST_ITEM_RE group
+# A leading bullet, then a leading number/letter marker, stripped in one pass
+LIST_STRIP_RE = re.compile(r'^(?:[•●◦▪▫■□◆◇*-]\s*)?(?:[\d\w]+[.)]\s*)?')
+
+# PDF parsing holds the GIL, so it runs in a process pool: pages are split
+# across workers and the request thread only waits, leaving the GIL to the
+# worker's other threads. os.cpu_count() reports the host's cores inside a
+# container, and every spawned worker re-imports this module, so the pool
+# follows the CPU affinity mask and is capped unless set explicitly.
+if hasattr(os, "sched_getaffinity"):
+    AVAILABLE_CPUS = len(os.sched_getaffinity(0))
+else:
+    AVAILABLE_CPUS = os.cpu_count() or 1
+PROCESS_POOL_WORKERS = int(os.environ.get("PROCESS_POOL_WORKERS") or min(AVAILABLE_CPUS, 4))
+STORE_SHRINK_INTERVAL = 16  # Pages between MuPDF cache flushes
+# Batch files converted per round before their outputs are flushed to the ZIP
+BATCH_CHUNK_SIZE = PROCESS_POOL_WORKERS * 2
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """Get the shared process pool, or None when running inside a pool worker"""
+    global process_pool
+    if PROCESS_POOL_WORKERS < 2 or multiprocessing.parent_process() is not None:
+        return None
+    
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=PROCESS_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+    return process_pool
+
+def discard_process_pool(pool):
+    """Drop a pool whose worker died, so the next caller starts a fresh one"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False)
+
+def schedule_on_pool(schedule):
+    """Return (pool, schedule(pool)), moving to a fresh pool if the shared one refuses work"""
+    pool = get_process_pool()
+    try:
+        return pool, schedule(pool)
+    except (BrokenProcessPool, RuntimeError):
+        # RuntimeError: another thread discarded and shut this pool down
+        # between our get_process_pool() and the submit
+        discard_process_pool(pool)
+        pool = get_process_pool()
+        return pool, schedule(pool)
+
+def pool_map(fn, *iterables):
+    """Map fn over the shared pool, replacing the pool and retrying once if a worker died"""
+    for attempt in range(2):
+        pool, results = schedule_on_pool(lambda pool: pool.map(fn, *iterables))
+        try:
+            return list(results)
+        except BrokenProcessPool:
+            # A crashed or OOM-killed worker breaks the pool for good
+            discard_process_pool(pool)
+            if attempt:
+                raise
+
+def submit_to_pool(fn, *args):
+    """Submit to the shared pool, returning (pool, future)"""
+    return schedule_on_pool(lambda pool: pool.submit(fn, *args))
+
+def pool_result(job, fn, *args):
+    """Wait for a submit_to_pool() job, resubmitting it once if its pool broke"""
+    pool, future = job
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        # A dead worker fails every job still pending on its pool, not just
+        # its own, so each gets one more try on the replacement
+        discard_process_pool(pool)
+        pool, future = submit_to_pool(fn, *args)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            discard_process_pool(pool)
+            raise
+
+def load_cached_blocks(cache_key):
+    """Load previously extracted blocks, or None on a cache miss"""
+    cache_path = os.path.join(EXTRACT_CACHE_DIR, cache_key)
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Truncated or stale entries can fail with almost anything (ValueError,
+        # AttributeError on renamed classes...); drop them and re-extract
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        return None
+
+def save_cached_blocks(cache_key, blocks):
+    """Persist extracted blocks, evicting the oldest entries past the size cap"""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=EXTRACT_CACHE_DIR, suffix=".tmp")
+    except OSError:
+        return  # The cache is an optimization; extraction already succeeded
+    
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(blocks, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(EXTRACT_CACHE_DIR, cache_key))
+    except (OSError, pickle.PicklingError):
+        # Don't leave a partial file behind, e.g. after filling the disk
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    
+    try:
+        entries = [entry for entry in os.scandir(EXTRACT_CACHE_DIR) if entry.name.endswith(".pickle")]
+        if len(entries) > EXTRACT_CACHE_MAX_ENTRIES:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - EXTRACT_CACHE_MAX_ENTRIES]:
+                os.remove(entry.path)
+    except OSError:
+        pass  # The cache is an optimization; extraction already succeeded
+
 def get_user_key():
     """Get unique identifier for tracking exports"""
     if 'user_id' in session:
@@ -42,166 +237,289 @@ def get_daily_limit():
     """Get daily export limit based on user status"""
     return LOGGED_IN_DAILY_LIMIT if is_logged_in() else GUEST_DAILY_LIMIT
 
-def check_and_update_exports(user_key):
-    """Check if user can export and update count"""
-    now = datetime.now()
-    today = now.date()
-    
-    if user_key not in export_tracking:
-        export_tracking[user_key] = {
-            'count': 0,
-            'date': today.isoformat(),
-            'last_export': now.isoformat()
-        }
-    
-    user_data = export_tracking[user_key]
-    last_date = datetime.fromisoformat(user_data['date']).date()
-    
-    # Reset if new day
-    if today > last_date:
-        user_data['count'] = 0
-        user_data['date'] = today.isoformat()
-    
+def todays_export_tracking(today):
+    """In-process export counts for today; callers hold export_tracking_lock"""
+    global export_tracking_day
+    # Counts only ever matter for the current day, so a new day drops every
+    # entry instead of letting one per user accumulate forever
+    if export_tracking_day != today:
+        export_tracking.clear()
+        export_tracking_day = today
+    return export_tracking
+
+def redis_export_key(user_key, today):
+    """Redis key holding a user's export count for the given day"""
+    return f"exports:{user_key}:{today.isoformat()}"
+
+def check_and_update_exports(user_key, n=1):
+    """Check if user can make n exports and update count, never past the limit"""
+    today = datetime.now().date()
     limit = get_daily_limit()
     
-    if user_data['count'] >= limit:
-        return False, user_data['count'], limit
+    if redis_client is not None:
+        # Atomic increment; the key expires at midnight so the daily reset is free
+        key = redis_export_key(user_key, today)
+        midnight = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        pipe = redis_client.pipeline()
+        pipe.incrby(key, n)
+        pipe.expireat(key, int(midnight.timestamp()))
+        count, _ = pipe.execute()
+        
+        if count > limit:
+            # Give back whatever went over the limit
+            excess = min(n, count - limit)
+            redis_client.decrby(key, excess)
+            return False, count - excess, limit
+        
+        return True, count, limit
     
-    # Increment count
-    user_data['count'] += 1
-    user_data['last_export'] = now.isoformat()
-    
-    return True, user_data['count'], limit
+    with export_tracking_lock:
+        counts = todays_export_tracking(today)
+        count = counts.get(user_key, 0)
+        
+        if count >= limit:
+            return False, count, limit
+        
+        # Increment count
+        new_count = min(count + n, limit)
+        counts[user_key] = new_count
+        
+        return new_count == count + n, new_count, limit
 
 def get_export_status(user_key):
     """Get current export status without incrementing"""
     today = datetime.now().date()
     
-    if user_key not in export_tracking:
-        return 0, get_daily_limit()
+    if redis_client is not None:
+        count = redis_client.get(redis_export_key(user_key, today))
+        return int(count or 0), get_daily_limit()
     
-    user_data = export_tracking[user_key]
-    last_date = datetime.fromisoformat(user_data['date']).date()
+    with export_tracking_lock:
+        count = todays_export_tracking(today).get(user_key, 0)
     
-    # Reset if new day
-    if today > last_date:
-        return 0, get_daily_limit()
+    return count, get_daily_limit()
+
+def escape_html(text):
+    """Escape text for an HTML element body or attribute value"""
+    return text.translate(HTML_ESCAPE)
+
+class Span:
+    """A run of uniformly formatted text within a line"""
+    __slots__ = ('text', 'bold', 'italic', 'size', 'font', 'heading',
+                 'is_list', 'list_type', 'alignment', 'bbox')
     
-    return user_data['count'], get_daily_limit()
+    def __init__(self, text, bold, italic, size, font, heading, is_list, list_type, alignment, bbox):
+        self.text = text
+        self.bold = bold
+        self.italic = italic
+        self.size = size
+        self.font = font
+        self.heading = heading
+        self.is_list = is_list
+        self.list_type = list_type
+        self.alignment = alignment
+        self.bbox = bbox
+
+# python-docx parses its bundled default template on every Document() call;
+# parse it once and hand each export a deep copy
+DOCX_TEMPLATE = Document()
+
+# Qualified WordprocessingML tag names used when writing runs directly
+W_R, W_RPR, W_T = qn('w:r'), qn('w:rPr'), qn('w:t')
+W_B, W_I, W_SZ, W_VAL = qn('w:b'), qn('w:i'), qn('w:sz'), qn('w:val')
+XML_SPACE = qn('xml:space')
+
+def append_docx_run(p, text, bold, italic, size=None):
+    """Append a <w:r> to a paragraph element without going through docx.text.Run"""
+    r = etree.SubElement(p, W_R)
+    if bold or italic or size:
+        rPr = etree.SubElement(r, W_RPR)
+        if bold:
+            etree.SubElement(rPr, W_B)
+        if italic:
+            etree.SubElement(rPr, W_I)
+        if size:
+            # w:sz is measured in half-points
+            etree.SubElement(rPr, W_SZ).set(W_VAL, str(int(size * 2)))
+    t = etree.SubElement(r, W_T)
+    t.text = text
+    t.set(XML_SPACE, 'preserve')
 
 class PDFFormatter:
     def __init__(self, pdf_path, layout_mode='preserve'):
+        self.pdf_path = pdf_path
         self.doc = fitz.open(pdf_path)
         self.formatted_content = []
         self.layout_mode = layout_mode
-        self.bullet_patterns = ['•', '●', '◦', '▪', '▫', '■', '□', '◆', '◇', '-', '*']
         
+    def _cache_key(self):
+        """Cache file name for this PDF's content and layout mode"""
+        # Hash straight from the page cache instead of reading the whole
+        # upload into a bytes object first
+        with open(self.pdf_path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hasher = hashlib.blake2b(mm, digest_size=16)
+        # The mode comes straight from the form, so it is hashed rather than
+        # placed in the file name
+        hasher.update(self.layout_mode.encode("utf-8"))
+        return f"{hasher.hexdigest()}_v{EXTRACT_CACHE_VERSION}.pickle"
+    
     def extract_with_formatting(self):
+        cache_key = self._cache_key()
+        cached = load_cached_blocks(cache_key)
+        if cached is not None:
+            self.doc.close()
+            self.formatted_content = cached
+            return self.formatted_content
+        
+        page_count = len(self.doc)
+        pool = get_process_pool()
+        
+        if pool is None or page_count == 0:
+            all_blocks = self._extract_page_range(0, page_count)
+            self.doc.close()
+        else:
+            # Workers re-open the file by path, one contiguous page range each.
+            # Even single-page documents go to the pool so extraction never
+            # blocks the other request threads; empty ones have no range to split.
+            self.doc.close()
+            step = -(-page_count // PROCESS_POOL_WORKERS)
+            starts = range(0, page_count, step)
+            stops = [min(start + step, page_count) for start in starts]
+            all_blocks = []
+            for page_blocks in pool_map(_extract_pages, repeat(self.pdf_path), starts, stops, repeat(self.layout_mode)):
+                all_blocks.extend(page_blocks)
+        
+        self.formatted_content = all_blocks
+        save_cached_blocks(cache_key, all_blocks)
+        return self.formatted_content
+    
+    def _extract_page_range(self, start, stop):
+        """Extract the blocks of pages start..stop-1, releasing native memory as it goes"""
         all_blocks = []
+        for count, page in enumerate(self.doc.pages(start, stop), 1):
+            all_blocks.extend(self._extract_page(page))
+            page = None
+            if count % STORE_SHRINK_INTERVAL == 0:
+                # Empty MuPDF's store of fonts/images from pages already done
+                fitz.TOOLS.store_shrink(100)
+        return all_blocks
+    
+    def _extract_page(self, page):
+        """Extract the formatted blocks of a single page"""
+        if self.layout_mode == 'clean':
+            return self._extract_page_clean(page)
         
-        for page_num in range(len(self.doc)):
-            page = self.doc[page_num]
-            page_rect = page.rect
-            page_width = page_rect.width
-            blocks = page.get_text("dict")["blocks"]
+        all_blocks = []
+        page_rect = page.rect
+        page_width = page_rect.width
+        blocks = page.get_text("dict", flags=DICT_FLAGS, sort=False)["blocks"]
+        
+        # Extract tables first if in preserve mode
+        tables = []
+        if self.layout_mode == 'preserve':
+            try:
+                page_tables = page.find_tables()
+                for table in page_tables:
+                    table_data = table.extract()
+                    table_bbox = table.bbox
+                    tables.append({
+                        'data': table_data,
+                        'bbox': table_bbox,
+                        'type': 'table'
+                    })
+            except Exception:
+                pass  # Table detection may fail on some PDFs
+        
+        # Most pages have no tables, so the overlap test is skipped outright
+        if tables:
+            tables_by_top = sorted(tables, key=lambda table: table['bbox'][1])
+            table_tops = [table['bbox'][1] for table in tables_by_top]
+        
+        for block in blocks:
+            # Text blocks only
+            if block["type"] != 0:
+                continue
             
-            # Extract tables first if in preserve mode
-            tables = []
-            if self.layout_mode == 'preserve':
-                try:
-                    page_tables = page.find_tables()
-                    for table in page_tables:
-                        table_data = table.extract()
-                        table_bbox = table.bbox
-                        tables.append({
-                            'data': table_data,
-                            'bbox': table_bbox,
-                            'type': 'table'
-                        })
-                except:
-                    pass  # Table detection may fail on some PDFs
+            block_bbox = block.get("bbox", EMPTY_BBOX)
             
-            for block in blocks:
-                if "lines" in block:
-                    block_bbox = block.get("bbox", [0, 0, 0, 0])
-                    
-                    # Skip blocks that are part of detected tables
-                    is_table_block = False
-                    for table in tables:
-                        if self._bbox_overlap(block_bbox, table['bbox']):
-                            is_table_block = True
-                            break
-                    
-                    if is_table_block:
-                        continue
-                    
-                    block_content = []
-                    block_y_positions = []
-                    
-                    for line in block["lines"]:
-                        line_content = []
-                        line_bbox = line.get("bbox", [0, 0, 0, 0])
-                        block_y_positions.append(line_bbox[1])  # y0 coordinate
+            # Skip blocks that are part of detected tables; only tables
+            # starting above the block's bottom edge can overlap it
+            if tables and any(self._bbox_overlap(block_bbox, tables_by_top[i]['bbox'])
+                              for i in range(bisect_right(table_tops, block_bbox[3]))):
+                continue
+            
+            block_content = []
+            block_y_positions = []
+            
+            for line in block["lines"]:
+                line_content = []
+                line_bbox = line.get("bbox", EMPTY_BBOX)
+                block_y_positions.append(line_bbox[1])  # y0 coordinate
+                
+                # Detect text alignment for this line
+                line_alignment = self._detect_text_alignment(line_bbox, page_width, block_bbox)
+                
+                for span in line["spans"]:
+                    text = span["text"].strip()
+                    if text:
+                        flags = span["flags"]
+                        size = span["size"]
+                        # Documents use a handful of fonts, so share one string per name
+                        font = sys.intern(span.get("font", ""))
                         
-                        # Detect text alignment for this line
-                        line_alignment = self._detect_text_alignment(line_bbox, page_width, block_bbox)
+                        is_bold = bool(flags & FLAG_BOLD)
+                        is_italic = bool(flags & FLAG_ITALIC)
                         
-                        for span in line["spans"]:
-                            text = span["text"].strip()
-                            if text:
-                                flags = span["flags"]
-                                size = span["size"]
-                                font = span.get("font", "")
-                                
-                                is_bold = bool(flags & 2**4)
-                                is_italic = bool(flags & 2**1)
-                                
-                                # Enhanced heading detection
-                                avg_size = 12  # Assumed average text size
-                                is_heading = (size > avg_size + 2) or (is_bold and size >= avg_size)
-                                heading_level = self._calculate_heading_level(size, is_bold, font)
-                                
-                                # Detect list items
-                                is_list_item = self._is_list_item(text)
-                                list_type = self._get_list_type(text) if is_list_item else None
-                                
-                                line_content.append({
-                                    'text': text,
-                                    'bold': is_bold,
-                                    'italic': is_italic,
-                                    'size': size,
-                                    'font': font,
-                                    'heading': heading_level,
-                                    'is_list': is_list_item,
-                                    'list_type': list_type,
-                                    'alignment': line_alignment,
-                                    'bbox': line_bbox
-                                })
+                        # Enhanced heading detection
+                        heading_level = self._calculate_heading_level(size, is_bold, font)
                         
-                        if line_content:
-                            block_content.append(line_content)
-                    
-                    if block_content:
-                        # Detect paragraph breaks based on spacing
-                        block_type = self._detect_block_type(block_content, block_y_positions)
-                        all_blocks.append({
-                            'content': block_content,
-                            'type': block_type,
-                            'bbox': block_bbox
-                        })
+                        # Detect list items; writers only read the marker
+                        # from a line's first span
+                        is_list_item = not line_content and self._is_list_item(text)
+                        list_type = self._get_list_type(text) if is_list_item else None
+                        
+                        line_content.append(Span(
+                            text, is_bold, is_italic, size, font, heading_level,
+                            is_list_item, list_type, line_alignment, line_bbox
+                        ))
+                
+                if line_content:
+                    block_content.append(line_content)
             
-            # Add tables to blocks
-            for table in tables:
-                all_blocks.append(table)
-        
-        self.formatted_content = all_blocks
-        self.doc.close()
-        return self.formatted_content
+            if block_content:
+                # Detect paragraph breaks based on spacing
+                block_type = self._detect_block_type(block_content, block_y_positions)
+                all_blocks.append({
+                    'content': block_content,
+                    'type': block_type,
+                    'bbox': block_bbox
+                })
+        
+        # Add tables to blocks
+        for table in tables:
+            all_blocks.append(table)
+        
+        return all_blocks
     
     def _bbox_overlap(self, bbox1, bbox2):
         """Check if two bounding boxes overlap"""
-        return not (bbox1[2] < bbox2[0] or bbox2[2] < bbox1[0] or 
-                   bbox1[3] < bbox2[1] or bbox2[3] < bbox1[1])
+        # Vertical test first: on long pages blocks and tables are most often
+        # disjoint in y, so the chain usually stops after one or two compares
+        ax0, ay0, ax1, ay1 = bbox1
+        bx0, by0, bx1, by1 = bbox2
+        return by1 >= ay0 and ay1 >= by0 and ax1 >= bx0 and bx1 >= ax0
+    
+    def _extract_page_clean(self, page):
+        """Extract a page as one unformatted block, one span per line"""
+        # Clean mode writers only concatenate span text, so MuPDF's plain text
+        # extractor stands in for the dict parse and span classification
+        page_bbox = tuple(page.rect)
+        lines = [[Span(text, False, False, 11, '', 0, False, None, ALIGN_LEFT, page_bbox)]
+                 for text in map(str.strip, page.get_text(flags=TEXT_FLAGS).splitlines()) if text]
+        if not lines:
+            return []
+        return [{'content': lines, 'type': 'paragraph', 'bbox': page_bbox}]
     
     def _calculate_heading_level(self, size, is_bold, font):
         """Calculate heading level based on font properties"""
@@ -226,51 +544,27 @@ class PDFFormatter:
         if not text:
             return False
         
-        # Check for bullet points
-        for bullet in self.bullet_patterns:
-            if text.startswith(bullet + ' ') or text.startswith(bullet + '\t'):
-                return True
-        
-        # Check for numbered lists (1., 1), a., a), i., etc.)
-        import re
-        numbered_patterns = [
-            r'^\d+\.\s',  # 1. 2. 3.
-            r'^\d+\)\s',  # 1) 2) 3)
-            r'^[a-zA-Z]\.\s',  # a. b. c.
-            r'^[a-zA-Z]\)\s',  # a) b) c)
-            r'^[ivxlcdm]+\.\s',  # i. ii. iii. (roman numerals)
-            r'^[IVXLCDM]+\.\s'   # I. II. III.
-        ]
-        
-        for pattern in numbered_patterns:
-            if re.match(pattern, text):
-                return True
-        
-        return False
+        # Bullet points, then numbered lists (1., 1), a., a), i., etc.)
+        return text.startswith(BULLET_PREFIXES) or LIST_ITEM_RE.match(text) is not None
     
     def _get_list_type(self, text):
         """Determine the type of list (bullet, numbered, etc.)"""
         if not text:
             return None
         
-        for bullet in self.bullet_patterns:
-            if text.startswith(bullet):
-                return 'bullet'
+        if text.startswith(BULLET_PATTERNS):
+            return 'bullet'
         
-        import re
-        if re.match(r'^\d+[\.\)]\s', text):
-            return 'numbered'
-        elif re.match(r'^[a-zA-Z][\.\)]\s', text):
-            return 'lettered'
-        elif re.match(r'^[ivxlcdmIVXLCDM]+\.\s', text):
-            return 'roman'
+        match = LIST_ITEM_RE.match(text)
+        if match:
+            return LIST_ITEM_TYPES[match.lastindex]
         
         return 'bullet'
     
     def _detect_text_alignment(self, line_bbox, page_width, block_bbox=None):
         """Detect text alignment based on position within page/block"""
         if not line_bbox or len(line_bbox) < 4:
-            return 'left'
+            return ALIGN_LEFT
         
         x0, y0, x1, y1 = line_bbox
         line_width = x1 - x0
@@ -294,16 +588,16 @@ class PDFFormatter:
         # Detect alignment based on margins
         if abs(line_left_margin - line_right_margin) < center_threshold:
             # Text is roughly centered
-            return 'center'
+            return ALIGN_CENTER
         elif line_right_margin < margin_threshold and line_left_margin > container_width * 0.3:
             # Text is close to right edge with significant left margin
-            return 'right'
+            return ALIGN_RIGHT
         elif line_left_margin < margin_threshold:
             # Text is close to left edge
-            return 'left'
+            return ALIGN_LEFT
         else:
             # Default to left if unclear
-            return 'left'
+            return ALIGN_LEFT
     
     def _detect_block_type(self, block_content, y_positions):
         """Detect if block is paragraph, heading, list, etc."""
@@ -311,14 +605,23 @@ class PDFFormatter:
             return 'text'
         
         first_line = block_content[0]
-        if first_line and first_line[0].get('heading', 0) > 0:
+        if first_line and first_line[0].heading > 0:
             return 'heading'
         
-        if any(line and line[0].get('is_list', False) for line in block_content):
+        if any(line and line[0].is_list for line in block_content):
             return 'list'
         
         return 'paragraph'
     
+    def _write_spans(self, out, spans, fmt):
+        """Append each span's text, formatted as 'plain', 'html' (escaped) or 'md', followed by a space"""
+        wrap = SPAN_WRAPS[fmt]
+        escape = fmt == 'html'
+        for span in spans:
+            text = span.text.translate(HTML_ESCAPE) if escape else span.text
+            out.append(wrap[span.bold, span.italic] % text)
+            out.append(' ')
+    
     def to_html(self):
         html_content = ['<!DOCTYPE html>', '<html>', '<head>', '<meta charset="UTF-8">', 
                        '<title>PDF Content</title>', 
@@ -350,18 +653,15 @@ class PDFFormatter:
         html_content = ['<!DOCTYPE html>', '<html>', '<head>', '<meta charset="UTF-8">', 
                        '<title>PDF Content</title>', '</head>', '<body>', '<div>']
         
-        all_text = []
+        out = []
         for block in self.formatted_content:
             if block.get('type') == 'table':
                 continue  # Skip tables in clean mode
             
-            block_content = block.get('content', [])
-            for line in block_content:
-                line_text = ' '.join([span['text'] for span in line])
-                if line_text.strip():
-                    all_text.append(line_text.strip())
+            for line in block.get('content', []):
+                self._write_spans(out, line, 'plain')
         
-        html_content.append('<p>' + ' '.join(all_text) + '</p>')
+        html_content.append('<p>' + escape_html(''.join(out).rstrip()) + '</p>')
         html_content.extend(['</div>', '</body>', '</html>'])
         return '\n'.join(html_content)
     
@@ -369,12 +669,16 @@ class PDFFormatter:
         if not block_content or not block_content[0]:
             return []
         
-        heading_level = block_content[0][0].get('heading', 3)
-        alignment = block_content[0][0].get('alignment', 'left')
-        text_content = ' '.join([' '.join([span['text'] for span in line]) for line in block_content])
+        first = block_content[0][0]
+        heading_level = first.heading
+        alignment = first.alignment
+        out = []
+        for line in block_content:
+            self._write_spans(out, line, 'plain')
+        text_content = ''.join(out).rstrip()
         
-        align_style = f' style="text-align: {alignment};"' if alignment != 'left' else ''
-        return [f'<h{heading_level}{align_style}>{text_content}</h{heading_level}>']
+        align_style = f' style="text-align: {ALIGNMENT_NAMES[alignment]};"' if alignment != ALIGN_LEFT else ''
+        return [f'<h{heading_level}{align_style}>{escape_html(text_content)}</h{heading_level}>']
     
     def _block_to_html_list(self, block_content):
         html_lines = []
@@ -386,8 +690,8 @@ class PDFFormatter:
                 continue
                 
             first_span = line[0]
-            if first_span.get('is_list'):
-                list_type = first_span.get('list_type', 'bullet')
+            if first_span.is_list:
+                list_type = first_span.list_type
                 
                 # Start new list if needed
                 if not list_open or list_type != current_list_type:
@@ -403,25 +707,20 @@ class PDFFormatter:
                     current_list_type = list_type
                 
                 # Remove bullet/number from text
-                text_content = first_span['text']
-                for bullet in self.bullet_patterns:
-                    if text_content.startswith(bullet):
-                        text_content = text_content[len(bullet):].strip()
-                        break
-                
-                import re
-                text_content = re.sub(r'^[\d\w]+[\.\)]\s*', '', text_content)
+                text_content = LIST_STRIP_RE.sub('', first_span.text, count=1)
                 
                 # Add remaining spans
-                for span in line[1:]:
-                    text_content += ' ' + span['text']
+                out = [text_content, ' ']
+                self._write_spans(out, line[1:], 'plain')
                 
-                html_lines.append(f'<li>{text_content.strip()}</li>')
+                html_lines.append(f'<li>{escape_html("".join(out).strip())}</li>')
             else:
                 # Regular text in list context
-                text_content = ' '.join([span['text'] for span in line])
-                if text_content.strip():
-                    html_lines.append(f'<p>{text_content}</p>')
+                out = []
+                self._write_spans(out, line, 'plain')
+                text_content = ''.join(out).rstrip()
+                if text_content:
+                    html_lines.append(f'<p>{escape_html(text_content)}</p>')
         
         if list_open:
             html_lines.append('</ul>' if current_list_type == 'bullet' else '</ol>')
@@ -433,24 +732,17 @@ class PDFFormatter:
             return []
         
         # Get alignment from first line
-        alignment = block_content[0][0].get('alignment', 'left') if block_content[0] else 'left'
-        align_style = f' style="text-align: {alignment};"' if alignment != 'left' else ''
+        alignment = block_content[0][0].alignment if block_content[0] else ALIGN_LEFT
+        align_style = f' style="text-align: {ALIGNMENT_NAMES[alignment]};"' if alignment != ALIGN_LEFT else ''
         
-        p_content = f'<p{align_style}>'
+        parts = [f'<p{align_style}>']
+        line_break = '<br>' if len(block_content) > 1 else ''
         for line in block_content:
-            for span in line:
-                text = span['text']
-                if span['bold'] and span['italic']:
-                    text = f'<strong><em>{text}</em></strong>'
-                elif span['bold']:
-                    text = f'<strong>{text}</strong>'
-                elif span['italic']:
-                    text = f'<em>{text}</em>'
-                p_content += text + ' '
-            p_content += '<br>' if len(block_content) > 1 else ''
-        
-        p_content += '</p>'
-        return [p_content]
+            self._write_spans(parts, line, 'html')
+            parts.append(line_break)
+        
+        parts.append('</p>')
+        return [''.join(parts)]
     
     def _table_to_html(self, table_data):
         if not table_data:
@@ -465,7 +757,7 @@ class PDFFormatter:
         if has_headers:
             html.append('<thead><tr>')
             for cell in first_row:
-                html.append(f'<th>{cell or ""}</th>')
+                html.append(f'<th>{escape_html(cell or "")}</th>')
             html.append('</tr></thead>')
             data_rows = table_data[1:]
         else:
@@ -475,7 +767,7 @@ class PDFFormatter:
         for row in data_rows:
             html.append('<tr>')
             for cell in row:
-                html.append(f'<td>{cell or ""}</td>')
+                html.append(f'<td>{escape_html(cell or "")}</td>')
             html.append('</tr>')
         html.append('</tbody>')
         
@@ -505,36 +797,33 @@ class PDFFormatter:
         return '\n\n'.join([item for item in markdown_content if item.strip()])
     
     def _to_markdown_clean(self):
-        all_text = []
+        out = []
         for block in self.formatted_content:
             if block.get('type') == 'table':
                 continue
             
-            block_content = block.get('content', [])
-            for line in block_content:
-                line_text = ' '.join([span['text'] for span in line])
-                if line_text.strip():
-                    all_text.append(line_text.strip())
+            for line in block.get('content', []):
+                self._write_spans(out, line, 'plain')
         
-        return ' '.join(all_text)
+        return ''.join(out).rstrip()
     
     def _block_to_markdown_heading(self, block_content):
         if not block_content or not block_content[0]:
             return []
         
-        heading_level = block_content[0][0].get('heading', 3)
-        alignment = block_content[0][0].get('alignment', 'left')
-        text_content = ' '.join([' '.join([span['text'] for span in line]) for line in block_content])
+        first = block_content[0][0]
+        heading_level = first.heading
+        alignment = first.alignment
+        out = []
+        for line in block_content:
+            self._write_spans(out, line, 'plain')
+        text_content = ''.join(out).rstrip()
         
         heading_text = '#' * heading_level + ' ' + text_content
         
         # Add HTML alignment for non-left aligned headings in Markdown
-        if alignment == 'center':
-            heading_text += '\n<div align="center">' + text_content + '</div>'
-            return [heading_text]
-        elif alignment == 'right':
-            heading_text += '\n<div align="right">' + text_content + '</div>'
-            return [heading_text]
+        if alignment != ALIGN_LEFT:
+            heading_text += f'\n<div align="{ALIGNMENT_NAMES[alignment]}">' + escape_html(text_content) + '</div>'
         
         return [heading_text]
     
@@ -546,29 +835,16 @@ class PDFFormatter:
                 continue
                 
             first_span = line[0]
-            if first_span.get('is_list'):
-                list_type = first_span.get('list_type', 'bullet')
+            if first_span.is_list:
+                list_type = first_span.list_type
                 
                 # Remove bullet/number from text
-                text_content = first_span['text']
-                for bullet in self.bullet_patterns:
-                    if text_content.startswith(bullet):
-                        text_content = text_content[len(bullet):].strip()
-                        break
-                
-                import re
-                text_content = re.sub(r'^[\d\w]+[\.\)]\s*', '', text_content)
+                text_content = LIST_STRIP_RE.sub('', first_span.text, count=1)
                 
                 # Add remaining spans with formatting
-                for span in line[1:]:
-                    span_text = span['text']
-                    if span['bold'] and span['italic']:
-                        span_text = f'***{span_text}***'
-                    elif span['bold']:
-                        span_text = f'**{span_text}**'
-                    elif span['italic']:
-                        span_text = f'*{span_text}*'
-                    text_content += ' ' + span_text
+                out = [text_content, ' ']
+                self._write_spans(out, line[1:], 'md')
+                text_content = ''.join(out)
                 
                 if list_type == 'numbered':
                     markdown_lines.append(f'1. {text_content.strip()}')
@@ -576,19 +852,11 @@ class PDFFormatter:
                     markdown_lines.append(f'- {text_content.strip()}')
             else:
                 # Regular text
-                line_text = ''
-                for span in line:
-                    text = span['text']
-                    if span['bold'] and span['italic']:
-                        text = f'***{text}***'
-                    elif span['bold']:
-                        text = f'**{text}**'
-                    elif span['italic']:
-                        text = f'*{text}*'
-                    line_text += text + ' '
-                
-                if line_text.strip():
-                    markdown_lines.append(line_text.strip())
+                out = []
+                self._write_spans(out, line, 'md')
+                line_text = ''.join(out).strip()
+                if line_text:
+                    markdown_lines.append(line_text)
         
         return markdown_lines
     
@@ -597,31 +865,17 @@ class PDFFormatter:
             return []
         
         # Get alignment from first line
-        alignment = block_content[0][0].get('alignment', 'left') if block_content[0] else 'left'
+        alignment = block_content[0][0].alignment if block_content[0] else ALIGN_LEFT
         
-        paragraph_lines = []
+        out = []
         for line in block_content:
-            line_text = ''
-            for span in line:
-                text = span['text']
-                if span['bold'] and span['italic']:
-                    text = f'***{text}***'
-                elif span['bold']:
-                    text = f'**{text}**'
-                elif span['italic']:
-                    text = f'*{text}*'
-                line_text += text + ' '
-            
-            if line_text.strip():
-                paragraph_lines.append(line_text.strip())
+            self._write_spans(out, line, 'md')
         
-        paragraph_text = ' '.join(paragraph_lines)
+        paragraph_text = ''.join(out).rstrip()
         
         # Add HTML alignment for non-left aligned paragraphs in Markdown
-        if alignment == 'center':
-            return [f'<div align="center">{paragraph_text}</div>']
-        elif alignment == 'right':
-            return [f'<div align="right">{paragraph_text}</div>']
+        if alignment != ALIGN_LEFT:
+            return [f'<div align="{ALIGNMENT_NAMES[alignment]}">{escape_html(paragraph_text)}</div>']
         
         return [paragraph_text]
     
@@ -648,7 +902,7 @@ class PDFFormatter:
         return '\n'.join(markdown_lines)
     
     def to_docx(self):
-        document = Document()
+        document = copy.deepcopy(DOCX_TEMPLATE)
         
         if self.layout_mode == 'clean':
             return self._to_docx_clean(document)
@@ -670,57 +924,43 @@ class PDFFormatter:
         return document
     
     def _to_docx_clean(self, document):
-        all_text = []
+        out = []
         for block in self.formatted_content:
             if block.get('type') == 'table':
                 continue
             
-            block_content = block.get('content', [])
-            for line in block_content:
-                line_text = ' '.join([span['text'] for span in line])
-                if line_text.strip():
-                    all_text.append(line_text.strip())
+            for line in block.get('content', []):
+                self._write_spans(out, line, 'plain')
         
-        paragraph = document.add_paragraph(' '.join(all_text))
+        paragraph = document.add_paragraph(''.join(out).rstrip())
         return document
     
     def _add_heading_to_docx(self, document, block_content):
         if not block_content or not block_content[0]:
             return
         
-        heading_level = min(9, block_content[0][0].get('heading', 3))
-        alignment = block_content[0][0].get('alignment', 'left')
-        text_content = ' '.join([' '.join([span['text'] for span in line]) for line in block_content])
+        first = block_content[0][0]
+        heading_level = min(9, first.heading)
+        alignment = first.alignment
+        out = []
+        for line in block_content:
+            self._write_spans(out, line, 'plain')
+        text_content = ''.join(out).rstrip()
         
         heading = document.add_heading(text_content, level=heading_level)
         
         # Set alignment
-        if alignment == 'center':
-            heading.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-        elif alignment == 'right':
-            heading.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        elif alignment == 'left':
-            heading.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        heading.alignment = DOCX_ALIGNMENTS[alignment]
     
     def _add_list_to_docx(self, document, block_content):
-        from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-        from docx.shared import Inches
-        
         for line in block_content:
             if not line:
                 continue
                 
             first_span = line[0]
-            if first_span.get('is_list'):
+            if first_span.is_list:
                 # Remove bullet/number from text
-                text_content = first_span['text']
-                for bullet in self.bullet_patterns:
-                    if text_content.startswith(bullet):
-                        text_content = text_content[len(bullet):].strip()
-                        break
-                
-                import re
-                text_content = re.sub(r'^[\d\w]+[\.\)]\s*', '', text_content)
+                text_content = LIST_STRIP_RE.sub('', first_span.text, count=1)
                 
                 # Create list paragraph
                 paragraph = document.add_paragraph()
@@ -728,16 +968,12 @@ class PDFFormatter:
                 paragraph.paragraph_format.left_indent = Inches(0.25)
                 
                 # Add first span text
-                run = paragraph.add_run(text_content)
-                run.bold = first_span.get('bold', False)
-                run.italic = first_span.get('italic', False)
+                p = paragraph._p
+                append_docx_run(p, text_content, first_span.bold, first_span.italic)
                 
                 # Add remaining spans
                 for span in line[1:]:
-                    run = paragraph.add_run(' ' + span['text'])
-                    run.bold = span.get('bold', False)
-                    run.italic = span.get('italic', False)
-                    run.font.size = Pt(span.get('size', 11))
+                    append_docx_run(p, ' ' + span.text, span.bold, span.italic, span.size)
             else:
                 # Regular paragraph in list context
                 self._add_paragraph_to_docx(document, [line])
@@ -747,24 +983,20 @@ class PDFFormatter:
             return
         
         # Get alignment from first line
-        alignment = block_content[0][0].get('alignment', 'left') if block_content[0] else 'left'
+        alignment = block_content[0][0].alignment if block_content[0] else ALIGN_LEFT
         
         paragraph = document.add_paragraph()
         
         # Set alignment
-        if alignment == 'center':
-            paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-        elif alignment == 'right':
-            paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        elif alignment == 'left':
-            paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        paragraph.alignment = DOCX_ALIGNMENTS[alignment]
         
+        # Runs are written straight into the <w:p> element; Run's property
+        # setters re-query the XML tree on every assignment
+        p = paragraph._p
         for line in block_content:
             for span in line:
-                run = paragraph.add_run(span['text'] + ' ')
-                run.bold = span.get('bold', False)
-                run.italic = span.get('italic', False)
-                run.font.size = Pt(span.get('size', 11) if span.get('size', 0) > 8 else 11)
+                append_docx_run(p, span.text + ' ', span.bold, span.italic,
+                                span.size if span.size > 8 else 11)
     
     def _add_table_to_docx(self, document, table_data):
         if not table_data:
@@ -786,9 +1018,110 @@ class PDFFormatter:
                             for run in paragraph.runs:
                                 run.bold = True
 
+def _extract_pages(pdf_path, start, stop, layout_mode):
+    """Process pool entry point: extract the blocks of a contiguous page range"""
+    formatter = PDFFormatter(pdf_path, layout_mode)
+    try:
+        return formatter._extract_page_range(start, stop)
+    finally:
+        formatter.doc.close()
+
+def extract_plain_text(pdf_path):
+    """Unformatted text of every page, each followed by a newline"""
+    with fitz.open(pdf_path) as doc:
+        return "".join([page.get_text("text", flags=TEXT_FLAGS, sort=False) + "\n" for page in doc])
+
+def extract_plain_preserve(pdf_path):
+    """Preserve-mode plain text, one line of the PDF per paragraph, read straight from MuPDF"""
+    # Only the line text is needed, so no blocks, spans or tables are built
+    all_text = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            lines = page.get_text("text", flags=TEXT_FLAGS, sort=False).splitlines()
+            all_text.extend(filter(None, map(str.strip, lines)))
+    
+    return "\n\n".join(all_text)
+
+def convert_single_pdf(pdf_bytes, filename, formats, layout_mode):
+    """Batch worker: convert one PDF to every requested format, returning {format: file bytes}"""
+    print(f"DEBUG: Processing file {filename}")
+    
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(pdf_bytes)
+    
+    outputs = {}
+    try:
+        # txt reads the PDF directly, so the formatter's blocks are only
+        # extracted when some other requested format needs them
+        if any(format_type != "txt" for format_type in formats):
+            formatter = PDFFormatter(pdf_path, layout_mode)
+            formatter.extract_with_formatting()
+            print(f"DEBUG: Extracted formatting for {filename}")
+        
+        # Convert to each requested format
+        for format_type in formats:
+            print(f"DEBUG: Converting {filename} to {format_type}")
+            
+            if format_type == "txt":
+                # Generate plain text
+                if layout_mode == "preserve":
+                    txt_content = extract_plain_preserve(pdf_path)
+                else:
+                    # Simple text extraction
+                    txt_content = extract_plain_text(pdf_path)
+                
+                outputs[format_type] = txt_content.encode("utf-8")
+            
+            elif format_type == "html":
+                outputs[format_type] = formatter.to_html().encode("utf-8")
+            
+            elif format_type == "markdown":
+                outputs[format_type] = formatter.to_markdown().encode("utf-8")
+            
+            elif format_type == "docx":
+                buffer = io.BytesIO()
+                formatter.to_docx().save(buffer)
+                outputs[format_type] = buffer.getvalue()
+            
+            print(f"DEBUG: Successfully converted to {format_type}")
+    finally:
+        os.remove(pdf_path)
+    
+    return outputs
+
+def save_upload(file):
+    """Save an uploaded PDF under a unique name, removed once the response is built"""
+    # Concurrent uploads of the same file name must not share a path
+    fd, filepath = tempfile.mkstemp(suffix=".pdf", dir=UPLOAD_FOLDER)
+    os.close(fd)
+    file.save(filepath)
+    remove_after_request(filepath)
+    return filepath
+
+def remove_after_request(path):
+    """Delete a file once the current response has been built"""
+    @after_this_request
+    def remove_file(response):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return response
+
+def read_page(name):
+    """Read a static page from next to this module, whatever the working directory"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+        return f.read()
+
+# The static pages are read once at import instead of on every GET
+INDEX_HTML = read_page("index.html")
+VIEWER_HTML = read_page("viewer.html")
+BATCH_HTML = read_page("batch.html")
+
 @app.route("/", methods=["GET"])
 def index():
-    return open("index.html", encoding="utf-8").read()
+    return Response(INDEX_HTML, mimetype="text/html")
 
 @app.route("/login", methods=["POST"])
 def login():
@@ -837,11 +1170,50 @@ def user_status():
 
 @app.route("/viewer", methods=["GET"])
 def viewer():
-    return open("viewer.html", encoding="utf-8").read()
+    return Response(VIEWER_HTML, mimetype="text/html")
 
 @app.route("/batch", methods=["GET"])
 def batch():
-    return open("batch.html", encoding="utf-8").read()
+    return Response(BATCH_HTML, mimetype="text/html")
+
+def batch_limit_response(current_exports, limit, file_count):
+    """429 response for a batch that does not fit in the remaining exports"""
+    remaining = limit - current_exports
+    user_type = "Logged-in User" if is_logged_in() else "Guest User"
+    
+    if remaining <= 0:
+        if is_logged_in():
+            message = f"Daily export limit reached ({limit} exports/day). Try again tomorrow."
+        else:
+            message = f"You've reached your {limit} export limit. Log in to get 3x more exports per day!"
+    else:
+        message = f"Not enough exports remaining. You have {remaining} exports left but trying to process {file_count} files. Please reduce the number of files or try again tomorrow."
+    
+    return jsonify({
+        "error": message,
+        "limit_reached": True,
+        "user_type": user_type,
+        "current_count": current_exports,
+        "limit": limit,
+        "remaining": remaining,
+        "requested": file_count
+    }), 429
+
+@app.before_request
+def precheck_batch_limit():
+    """Reject an over-limit batch from its X-File-Count header, before the upload is parsed"""
+    if request.method != "POST" or request.path != "/batch-convert":
+        return None
+    
+    try:
+        file_count = int(request.headers["X-File-Count"])
+    except (KeyError, ValueError):
+        return None  # No usable hint; batch_convert checks the parsed files
+    
+    current_exports, limit = get_export_status(get_user_key())
+    if current_exports + file_count > limit:
+        return batch_limit_response(current_exports, limit, file_count)
+    return None
 
 @app.route("/batch-convert", methods=["POST"])
 def batch_convert():
@@ -853,31 +1225,14 @@ def batch_convert():
         
         # Check export limits for batch processing
         user_key = get_user_key()
-        file_count = len([f for f in pdf_files if f.filename])
+        valid_files = [f for f in pdf_files if f and f.filename]
+        file_count = len(valid_files)
         
-        # Check if user has enough exports remaining
+        # Check if user has enough exports remaining; precheck_batch_limit
+        # already did this for clients that send X-File-Count
         current_exports, limit = get_export_status(user_key)
         if current_exports + file_count > limit:
-            remaining = limit - current_exports
-            user_type = "Logged-in User" if is_logged_in() else "Guest User"
-            
-            if remaining <= 0:
-                if is_logged_in():
-                    message = f"Daily export limit reached ({limit} exports/day). Try again tomorrow."
-                else:
-                    message = f"You've reached your {limit} export limit. Log in to get 3x more exports per day!"
-            else:
-                message = f"Not enough exports remaining. You have {remaining} exports left but trying to process {file_count} files. Please reduce the number of files or try again tomorrow."
-            
-            return jsonify({
-                "error": message,
-                "limit_reached": True,
-                "user_type": user_type,
-                "current_count": current_exports,
-                "limit": limit,
-                "remaining": remaining,
-                "requested": file_count
-            }), 429
+            return batch_limit_response(current_exports, limit, file_count)
         
         print(f"DEBUG: Received {len(pdf_files)} files")
         print(f"DEBUG: Formats string: {formats_str}")
@@ -889,116 +1244,70 @@ def batch_convert():
         except:
             formats = ["txt"]
         
-        if not pdf_files or len(pdf_files) == 0:
+        if not valid_files:
             return jsonify({"error": "No files provided"}), 400
         
         # Create a persistent temporary directory
         temp_dir = tempfile.mkdtemp()
         print(f"DEBUG: Using temp directory: {temp_dir}")
         
+        # Removed once the response is ready, whatever it turns out to be;
+        # send_file already holds the ZIP open by then
+        @after_this_request
+        def remove_temp_dir(response):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return response
+        
         try:
-            converted_files = []
-            
-            # Process each PDF file
-            for i, pdf_file in enumerate(pdf_files):
-                if not pdf_file or pdf_file.filename == '':
-                    print(f"DEBUG: Skipping empty file at index {i}")
-                    continue
-                
-                print(f"DEBUG: Processing file {i+1}: {pdf_file.filename}")
-                
-                # Save uploaded file
-                original_name = os.path.splitext(pdf_file.filename)[0]
-                pdf_path = os.path.join(temp_dir, f"{original_name}.pdf")
-                pdf_file.save(pdf_path)
-                print(f"DEBUG: Saved PDF to {pdf_path}")
-                
-                try:
-                    # Initialize formatter
-                    formatter = PDFFormatter(pdf_path, layout_mode)
-                    formatter.extract_with_formatting()
-                    print(f"DEBUG: Extracted formatting for {pdf_file.filename}")
-                    
-                    # Convert to each requested format
-                    for format_type in formats:
-                        print(f"DEBUG: Converting {pdf_file.filename} to {format_type}")
-                        
-                        output_filename = f"{original_name}.{format_type}"
-                        format_dir = os.path.join(temp_dir, format_type)
-                        os.makedirs(format_dir, exist_ok=True)
-                        output_path = os.path.join(format_dir, output_filename)
-                        
-                        if format_type == "txt":
-                            # Generate plain text
-                            if layout_mode == "preserve":
-                                all_text = []
-                                for block in formatter.formatted_content:
-                                    if block.get('type') == 'table':
-                                        continue
-                                    
-                                    block_content = block.get('content', [])
-                                    for line in block_content:
-                                        line_text = ' '.join([span['text'] for span in line])
-                                        if line_text.strip():
-                                            all_text.append(line_text.strip())
-                                
-                                txt_content = '\n\n'.join(all_text)
-                            else:
-                                # Simple text extraction
-                                doc = fitz.open(pdf_path)
-                                txt_content = ""
-                                try:
-                                    for page in doc:
-                                        txt_content += page.get_text("text") + "\n"
-                                finally:
-                                    doc.close()
-                            
-                            with open(output_path, "w", encoding="utf-8") as f:
-                                f.write(txt_content)
-                        
-                        elif format_type == "html":
-                            html_content = formatter.to_html()
-                            with open(output_path, "w", encoding="utf-8") as f:
-                                f.write(html_content)
-                        
-                        elif format_type == "markdown":
-                            markdown_content = formatter.to_markdown()
-                            with open(output_path, "w", encoding="utf-8") as f:
-                                f.write(markdown_content)
-                        
-                        elif format_type == "docx":
-                            docx_document = formatter.to_docx()
-                            docx_document.save(output_path)
-                        
-                        converted_files.append((format_type, output_path, output_filename))
-                        print(f"DEBUG: Successfully converted to {format_type}")
-                
-                except Exception as file_error:
-                    print(f"ERROR processing {pdf_file.filename}: {str(file_error)}")
-                    # Continue with other files even if one fails
-                    continue
-            
-            if not converted_files:
-                return jsonify({"error": "No files could be processed"}), 400
+            processed_count = 0
             
             # Create ZIP file with all converted files
             zip_filename = f"batch_conversion_{int(time.time())}.zip"
             zip_path = os.path.join(temp_dir, zip_filename)
             print(f"DEBUG: Creating ZIP at {zip_path}")
             
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for format_type, file_path, filename in converted_files:
-                    # Add file to ZIP with format-based folder structure
-                    arcname = os.path.join(format_type, filename)
-                    zipf.write(file_path, arcname)
-                    print(f"DEBUG: Added {arcname} to ZIP")
+            # Level 1 keeps most of the size win on text at a fraction of the CPU
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+                # Uploads are read here and each file is converted whole in its
+                # own pool worker, extraction and writers alike. Files go in
+                # chunks whose outputs are written out before the next chunk is
+                # read, so only one chunk of PDFs and outputs is held at a time.
+                pool = get_process_pool()
+                for chunk_start in range(0, file_count, BATCH_CHUNK_SIZE):
+                    jobs = []
+                    for pdf_file in valid_files[chunk_start:chunk_start + BATCH_CHUNK_SIZE]:
+                        original_name = os.path.splitext(pdf_file.filename)[0]
+                        args = (pdf_file.read(), pdf_file.filename, formats, layout_mode)
+                        job = None if pool is None else submit_to_pool(convert_single_pdf, *args)
+                        jobs.append((original_name, pdf_file.filename, args, job))
+                    
+                    for original_name, filename, args, job in jobs:
+                        try:
+                            if job is None:
+                                outputs = convert_single_pdf(*args)
+                            else:
+                                outputs = pool_result(job, convert_single_pdf, *args)
+                        except Exception as file_error:
+                            print(f"ERROR processing {filename}: {str(file_error)}")
+                            # Continue with other files even if one fails
+                            continue
+                        
+                        for format_type, data in outputs.items():
+                            # Add file to ZIP with format-based folder structure;
+                            # .docx files are zip archives already, so store them as is
+                            arcname = f"{format_type}/{original_name}.{format_type}"
+                            compress_type = zipfile.ZIP_STORED if format_type == "docx" else None
+                            zipf.writestr(arcname, data, compress_type=compress_type)
+                            print(f"DEBUG: Added {arcname} to ZIP")
+                        if outputs:
+                            processed_count += 1
                 
                 # Add a README file
                 readme_content = f"""PDF2Preserve Batch Conversion Results
 ==========================================
 
 Conversion Details:
-- Files processed: {len([f for f in pdf_files if f.filename])}
+- Files processed: {file_count}
 - Formats: {', '.join(formats)}
 - Layout mode: {layout_mode}
 - Conversion time: {time.strftime('%Y-%m-%d %H:%M:%S')}
@@ -1010,35 +1319,20 @@ Visit PDF2Preserve for more conversions!
 """
                 zipf.writestr("README.txt", readme_content)
             
+            if not processed_count:
+                return jsonify({"error": "No files could be processed"}), 400
+            
             print(f"DEBUG: ZIP file created successfully")
             
             # Update export count for processed files
-            processed_file_count = len(set([filename.split('.')[0] for _, _, filename in converted_files]))
-            for _ in range(processed_file_count):
-                check_and_update_exports(user_key)
+            check_and_update_exports(user_key, processed_count)
             
             # Return ZIP file
-            def remove_temp_dir():
-                try:
-                    import shutil
-                    shutil.rmtree(temp_dir)
-                except:
-                    pass
-            
-            # Schedule cleanup after response
-            import atexit
-            atexit.register(remove_temp_dir)
-            
-            return send_file(zip_path, as_attachment=True, download_name=zip_filename)
+            return send_file(zip_path, mimetype="application/zip", as_attachment=True,
+                             download_name=zip_filename)
         
         except Exception as inner_error:
             print(f"INNER ERROR: {str(inner_error)}")
-            # Clean up temp directory on error
-            try:
-                import shutil
-                shutil.rmtree(temp_dir)
-            except:
-                pass
             raise inner_error
     
     except Exception as e:
@@ -1058,51 +1352,22 @@ def extract_text():
             return jsonify({"error": "No file provided"}), 400
         
         # Save uploaded file temporarily
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
+        filepath = save_upload(file)
         
         # Initialize formatter with layout mode
         formatter = PDFFormatter(filepath, layout_mode)
         formatter.extract_with_formatting()
         
         # Generate text in different formats
-        txt_content = ""
         if layout_mode == "preserve":
-            all_text = []
-            for block in formatter.formatted_content:
-                if block.get('type') == 'table':
-                    continue  # Skip tables in text mode
-                
-                block_content = block.get('content', [])
-                for line in block_content:
-                    line_text = ' '.join([span['text'] for span in line])
-                    if line_text.strip():
-                        all_text.append(line_text.strip())
-            
-            txt_content = '\n\n'.join(all_text)
+            txt_content = extract_plain_preserve(filepath)
         else:
             # Simple text extraction
-            doc = fitz.open(filepath)
-            try:
-                for page in doc:
-                    txt_content += page.get_text("text") + "\n"
-            finally:
-                doc.close()
+            txt_content = extract_plain_text(filepath)
         
         html_content = formatter.to_html()
         markdown_content = formatter.to_markdown()
         
-        # Clean up uploaded file
-        try:
-            time.sleep(0.1)
-            os.remove(filepath)
-        except PermissionError:
-            time.sleep(0.5)
-            try:
-                os.remove(filepath)
-            except PermissionError:
-                pass  # Leave for manual cleanup
-        
         return jsonify({
             "txt": txt_content,
             "html": html_content,
@@ -1139,81 +1404,56 @@ def upload_pdf():
     layout_mode = request.form.get("layout_mode", "preserve")
     
     # Save uploaded file
-    filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(filepath)
-    
-    # Initialize formatter with layout mode
-    formatter = PDFFormatter(filepath, layout_mode)
+    filepath = save_upload(file)
+    output_stem = os.path.splitext(filepath)[0]
     
+    # The formatter is created per branch; txt never extracts its blocks
     if export_format == "txt":
         if layout_mode == "preserve":
-            # Extract with structure and convert to plain text
-            formatter.extract_with_formatting()
-            all_text = []
-            for block in formatter.formatted_content:
-                if block.get('type') == 'table':
-                    continue  # Skip tables in text mode
-                
-                block_content = block.get('content', [])
-                for line in block_content:
-                    line_text = ' '.join([span['text'] for span in line])
-                    if line_text.strip():
-                        all_text.append(line_text.strip())
-            
-            full_text = '\n\n'.join(all_text)
+            # Line-structured text without building the formatted blocks
+            full_text = extract_plain_preserve(filepath)
         else:
             # Simple text extraction (original behavior)
-            doc = fitz.open(filepath)
-            full_text = ""
-            try:
-                for page in doc:
-                    full_text += page.get_text("text") + "\n"
-            finally:
-                doc.close()
+            full_text = extract_plain_text(filepath)
         
-        output_path = filepath.replace(".pdf", ".txt")
+        output_path = output_stem + ".txt"
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(full_text)
             
     elif export_format == "html":
+        formatter = PDFFormatter(filepath, layout_mode)
         formatter.extract_with_formatting()
         html_content = formatter.to_html()
         
-        output_path = filepath.replace(".pdf", ".html")
+        output_path = output_stem + ".html"
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(html_content)
             
     elif export_format == "markdown":
+        formatter = PDFFormatter(filepath, layout_mode)
         formatter.extract_with_formatting()
         markdown_content = formatter.to_markdown()
         
-        output_path = filepath.replace(".pdf", ".md")
+        output_path = output_stem + ".md"
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(markdown_content)
             
     elif export_format == "docx":
+        formatter = PDFFormatter(filepath, layout_mode)
         formatter.extract_with_formatting()
         docx_document = formatter.to_docx()
         
-        output_path = filepath.replace(".pdf", ".docx")
+        output_path = output_stem + ".docx"
         docx_document.save(output_path)
     
-    # Clean up uploaded PDF with retry mechanism
-    try:
-        time.sleep(0.1)  # Small delay to ensure file handles are released
-        os.remove(filepath)
-    except PermissionError:
-        # If file is still locked, try again after a short delay
-        time.sleep(0.5)
-        try:
-            os.remove(filepath)
-        except PermissionError:
-            # If still locked, leave it for manual cleanup
-            pass
+    # The upload and its output have unique temp names; both are removed once
+    # the response is built (send_file has the output open by then)
+    remove_after_request(output_path)
+    download_name = os.path.splitext(file.filename)[0] + os.path.splitext(output_path)[1]
     
-    return send_file(output_path, as_attachment=True)
+    return send_file(output_path, as_attachment=True, download_name=download_name)
 
 if __name__ == "__main__":
-    # For Railway deployment - use environment PORT or default to 5000
+    # Local development server only; deployments run gunicorn via start.sh
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    app.run(host="0.0.0.0", port=port)
@@ -11,14 +11,15 @@ chmod 755 /tmp/uploads
 export PYTHONUNBUFFERED=1
 export PYTHONPATH=/app
 
-# Start the application
+# Start the application. One gthread worker: PDF parsing and conversion run in
+# the app's own process pool, which already spreads across every core. The
+# worker is never recycled: without REDIS_URL the export limits live in its memory
 exec gunicorn app:app \
     --bind 0.0.0.0:${PORT:-8000} \
     --workers 1 \
-    --threads 2 \
+    --worker-class gthread \
+    --threads 4 \
     --timeout 300 \
-    --max-requests 1000 \
-    --max-requests-jitter 100 \
     --preload \
     --access-logfile - \
     --error-logfile -
\ No newline at end of file